@@ -1,10 +1,21 @@
 import argparse
+import asyncio
 import os
+import shutil
 
 from .problem_props import (
-    build_cases, OriginLoc, ProblemCase, ProblemRegistry, setup_problem_dir
+    build_cases, OriginLoc, ProblemCase, ProblemRegistry,
+    setup_problem_dir_async
 )
 
+_CHOICES = tuple(ProblemRegistry)
+
+# maps each OriginLoc to the (grid_left_xyz, grid_width_xyz) of the base case
+_ORIGIN_GRID = {
+    OriginLoc.LEFT: ((0.0, 0.0, 0.0), (2.0, 2.0, 2.0)),
+    OriginLoc.CENTER: ((-4.0, -4.0, -4.0), (8.0, 8.0, 8.0)),
+}
+
 parser = argparse.ArgumentParser(
     description="assists with scaling tests"
 )
@@ -17,7 +28,7 @@ parser.add_argument(
 parser.add_argument(
     "--test-problem",
     required=True,
-    choices=list(ProblemRegistry.keys()),
+    choices=_CHOICES,
     nargs='+',
     help="the name of the test"
 )
@@ -34,6 +45,16 @@ parser.add_argument(
     help="max number of processes"
 )
 
+parser.add_argument(
+    "--build-cache",
+    action="store_true",
+    help=("reuse Cholla binaries previously compiled from identical "
+          "make.type files and Cholla source code (stored in "
+          "~/.cache/cholla_scaling, or under $XDG_CACHE_HOME). Beware: "
+          "changes to Cholla's source code are only detected when the cholla "
+          "directory is a git checkout, and untracked files are ignored")
+)
+
 make_job_grp = parser.add_mutually_exclusive_group()
 make_job_grp.add_argument(
     "--make-jflag-none", action="store_const", dest="make_jobs", const=False
@@ -46,13 +67,22 @@ make_job_grp.add_argument(
 )
 
 
+def _default_build_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME', '')
+    if cache_home == '':
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'cholla_scaling')
+
 
 def cli_main(override_args=None):
     args = parser.parse_args(override_args)
+    # every subprocess is launched from within this single event loop
+    return asyncio.run(_async_cli_main(args))
 
+
+async def _async_cli_main(args):
+    # None means that we use a default number of jobs
     make_jobs = getattr(args,'make_jobs', None)
-    if make_jobs is None:
-        make_jobs = False
 
     cholla_dir = args.cholla_dir
     assert os.path.isdir(cholla_dir)
@@ -61,32 +91,30 @@ def cli_main(override_args=None):
     max_nproc = args.max_nproc
     assert max_nproc > 0
 
+    build_cache_dir = _default_build_cache_dir() if args.build_cache else None
+
     base_dir = args.test_dir
-    if not os.path.isdir(base_dir):
-        os.mkdir(base_dir)
+    os.makedirs(base_dir, exist_ok=True)
 
     test_pairs = [
         (os.path.join(base_dir, name), ProblemRegistry[name])
-        for name in sorted(set(args.test_problem))
+        # drop duplicates, while preserving the order given by the user
+        for name in dict.fromkeys(args.test_problem)
     ]
 
-    for path,_ in filter(lambda p: os.path.exists(p[0]), test_pairs):
-        raise ValueError(f"the path `{path}` already exists")
+    # a single scan of base_dir lets us check every path at once
+    with os.scandir(base_dir) as it:
+        existing = {entry.name for entry in it}
+    for path,_ in test_pairs:
+        if os.path.basename(path) in existing:
+            raise ValueError(f"the path `{path}` already exists")
 
+    setup_kwargs = []
     for path, problem_prop in test_pairs:
         print(path)
         os.mkdir(path)
 
-
-        if problem_prop.origin_loc == OriginLoc.LEFT:
-            grid_left_xyz=(0.0, 0.0, 0.0)
-            grid_width_xyz=(2.0, 2.0, 2.0)
-        elif problem_prop.origin_loc == OriginLoc.CENTER:
-            grid_left_xyz=(-4.0, -4.0, -4.0)
-            grid_width_xyz=(8.0, 8.0, 8.0)
-        else:
-            raise RuntimeError()
-
+        grid_left_xyz, grid_width_xyz = _ORIGIN_GRID[problem_prop.origin_loc]
 
         base_problem_case = ProblemCase(
             grid_left_xyz=grid_left_xyz,
@@ -95,18 +123,50 @@ def cli_main(override_args=None):
             nproc_grid_xyz=(1,1,1) 
         )
 
-        case_itr = build_cases(
+        case_l = build_cases(
             base_problem_case,
             origin_loc=problem_prop.origin_loc,
             scale_rule=problem_prop.scale_rule,
             max_proc=args.max_nproc,
         )
-        case_l = list(case_itr)
         assert len(case_l) > 0
 
-        setup_problem_dir(
-            path, cholla_dir=cholla_dir, problem_props = problem_prop,
-            problem_cases = case_l, hostname = hostname, make_jobs=make_jobs
-        )
-
+        setup_kwargs.append(dict(
+            new_dir=path, cholla_dir=cholla_dir, problem_props=problem_prop,
+            problem_cases=case_l, hostname=hostname, make_jobs=make_jobs,
+            build_cache_dir=build_cache_dir
+        ))
+
+    # all coroutines share build_lock so that only 1 build occurs at a time
+    build_lock = asyncio.Lock()
+    abort = asyncio.Event()
+    tasks = [
+        asyncio.create_task(_setup_problem_dir(build_lock, abort, kwargs))
+        for kwargs in setup_kwargs
+    ]
+    # we let every task wind down on its own (rather than having asyncio.run
+    # cancel tasks that are in the middle of launching a subprocess)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    errors = []
+    for kwargs, result in zip(setup_kwargs, results):
+        if isinstance(result, BaseException):
+            errors.append(result)
+        elif not result:
+            # this problem was skipped (after another problem failed)
+            shutil.rmtree(kwargs['new_dir'])
+    if len(errors) > 0:
+        raise errors[0]
     return 0
+
+
+async def _setup_problem_dir(build_lock, abort, kwargs):
+    try:
+        return await setup_problem_dir_async(
+            build_lock=build_lock, abort=abort, **kwargs
+        )
+    except BaseException:
+        # this is set before any other task can acquire build_lock, so no
+        # other builds get started after a failure
+        abort.set()
+        raise
@@ -1,11 +1,12 @@
 import asyncio
 import shutil
+import sys
 import textwrap
 
 # based on this example
 # https://docs.python.org/3.9/library/asyncio-subprocess.html#examples
 
-async def _pretty_subprocess_run(args, **kwargs):
+async def pretty_subprocess_run_async(args, **kwargs):
 
     print("\nexecuting:")
     print(" -> command:", *args)
@@ -16,36 +17,56 @@ async def _pretty_subprocess_run(args, **kwargs):
     indent = '    '
     chunk_size = ncol-len(indent)
 
+    write = sys.stdout.write
+
     def _fmt_output(line):
-        line = line.decode('ascii')
-        nchunks, remainder = divmod(len(line), chunk_size)
-        next_start = 0
-        for i in range(0, nchunks + (remainder > 0)):
-            cur_start = next_start
-            next_start = chunk_size*(i+1)
-            print(indent, line[cur_start:next_start], sep='')
-
-    # Create the subprocess; redirect the standard output
-    # into a pipe.
+        # wrap the line & emit all of the wrapped pieces with a single write
+        # compiler diagnostics (now on the merged stream) may include
+        # non-ascii characters, like fancy quotes
+        line = line.decode('utf-8', errors='replace')
+        if line == '':
+            return None
+        write('\n'.join(
+            [indent + line[i:i+chunk_size]
+             for i in range(0, len(line), chunk_size)]
+        ))
+        write('\n')
+
+    # Create the subprocess; redirect the standard output into a pipe and
+    # (unless the caller says otherwise) merge the standard error into it.
+    # A single pipe means that a chatty stderr can't fill up an unread pipe
+    # and stall the process
+    kwargs.setdefault('stderr', asyncio.subprocess.STDOUT)
     proc = await asyncio.create_subprocess_exec(
         *args, stdout=asyncio.subprocess.PIPE, **kwargs
     )
-    while True:
-        line = await proc.stdout.readline()
-        if line == b'':
-            break
-        elif line.endswith(b'\n'):
-            _fmt_output(line[:-1])
-        else:
-            _fmt_output(line)
-            break
-
-    # Wait for the subprocess exit.
-    returncode = await proc.wait()
-    completed_output = proc.stdout.at_eof()
-    assert completed_output
+    try:
+        # read the output in large chunks (rather than line-by-line) to
+        # reduce the number of trips through the event loop
+        buf = b''
+        while chunk := await proc.stdout.read(65536):
+            buf += chunk
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                _fmt_output(line)
+        if buf != b'':
+            _fmt_output(buf)
+
+        # Wait for the subprocess exit.
+        returncode = await proc.wait()
+    except BaseException:
+        # we were cancelled (e.g. a concurrently scheduled task failed) or
+        # interrupted. Don't leave the child running unreaped
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+        raise
     print(f"returncode: {returncode}")
-    return True
+    return returncode
 
 def pretty_subprocess_run(args, **kwargs):
-    date = asyncio.run(_pretty_subprocess_run(args, **kwargs))
+    # prefer pretty_subprocess_run_async when an event loop is already running
+    return asyncio.run(pretty_subprocess_run_async(args, **kwargs))
@@ -1,21 +1,19 @@
+import asyncio
+import errno
 from enum import Enum, auto
 import functools
+import hashlib
+import math
 import os
 import shutil
 import subprocess
-from typing import NamedTuple, Tuple, Union
+from typing import List, NamedTuple, Optional, Tuple, Union
 
-from .pretty_subprocess import pretty_subprocess_run
+from .pretty_subprocess import pretty_subprocess_run_async
 
 _LOCAL_DIR = os.path.dirname(__file__)
 _MAKETYPE_PREFIX = 'make.type.'
 
-def _prod(iterable, *, start=1):
-    out=start
-    for elem in iterable:
-        out*=elem
-    return out
-
 
 class ProblemCase(NamedTuple):
     """
@@ -31,7 +29,7 @@ class ProblemCase(NamedTuple):
     nproc_grid_xyz: Tuple[int, int, int]
 
     def total_proc(self):
-        return _prod(self.nproc_grid_xyz)
+        return math.prod(self.nproc_grid_xyz)
 
 
 class OriginLoc(Enum):
@@ -46,6 +44,33 @@ class ScaleRule(Enum):
     # can increment xy-plane (while holding z-axis constant)
     XY_PLANE=auto()
 
+# maps each ScaleRule to the factors applied to the x, y, and z components
+# when going from one case to the next
+_SCALE_FACTORS = {
+    ScaleRule.X_AXIS: (2, 1, 1),
+    ScaleRule.Z_AXIS: (1, 1, 2),
+    ScaleRule.XY_PLANE: (2, 2, 1),
+}
+
+@functools.lru_cache(maxsize=None)
+def _scan_inputs(inputs_loc: str):
+    # the contents of inputs_loc don't change while we run, so we only need
+    # to scan each directory once. The directory is trusted & tiny, so we
+    # also skip stat-ing each entry
+    names = os.listdir(inputs_loc)
+    if len(names) != 2:
+        raise RuntimeError(
+            f"we expect `{inputs_loc}` to contain exactly 2 files"
+        )
+    maketype_names = [n for n in names if n.startswith(_MAKETYPE_PREFIX)]
+    param_names = [n for n in names if not n.startswith(_MAKETYPE_PREFIX)]
+    if len(maketype_names) == 0:
+        raise RuntimeError("no file looks like a make.type. file")
+    elif len(param_names) == 0:
+        raise RuntimeError("all files look like a make.type. file")
+    return (os.path.join(inputs_loc, maketype_names[0]),
+            os.path.join(inputs_loc, param_names[0]))
+
 class ProblemProps(NamedTuple):
     name: str
     origin_loc: OriginLoc
@@ -56,45 +81,23 @@ class ProblemProps(NamedTuple):
         return os.path.join(_LOCAL_DIR, self.name)
 
     def maketype_and_param_paths(self):
-        maketype_path, param_path = None, None
-        inputs_loc = self.inputs_loc
-
-        with os.scandir(inputs_loc) as it:
-            count = 0
-            for entry in filter(lambda entry: entry.is_file(), it):
-                count += 1
-                if count == 3:
-                    break
-                elif entry.name.startswith(_MAKETYPE_PREFIX):
-                    maketype_path = entry.path
-                else:
-                    param_path = entry.path
-        if count != 2:
-            raise RuntimeError(
-                f"we expect `{inputs_loc}` to contain exactly 2 files"
-            )
-        elif maketype_path is None:
-            raise RuntimeError("no file looks like a make.type. file")
-        elif param_path is None:
-            raise RuntimeError("all files look like a make.type. file")
-        return maketype_path, param_path
+        return _scan_inputs(self.inputs_loc)
 
 def _next_case(case: ProblemCase, origin_loc: OriginLoc, scale_rule: ScaleRule):
-    if scale_rule == ScaleRule.X_AXIS:
-        def generic_transform(triple):
-            return (triple[0]*2, triple[1], triple[2])
-    elif scale_rule == ScaleRule.Z_AXIS:
-        def generic_transform(triple):
-            return (triple[0], triple[1], triple[2]*2)
-    elif scale_rule == ScaleRule.XY_AXIS:
-        def generic_transform(triple):
-            return (triple[0]*2, triple[2]*2, triple[2])
-    else:
-        raise RuntimeError(f"missing branch for {scale_rule}")
+    try:
+        fx, fy, fz = _SCALE_FACTORS[scale_rule]
+    except KeyError:
+        raise RuntimeError(f"missing branch for {scale_rule}") from None
+
+    def generic_transform(triple):
+        return (triple[0]*fx, triple[1]*fy, triple[2]*fz)
 
     # apply generic_transform to each "generic_field" and store in a dict
-    generic_fields = ["grid_width_xyz", "grid_shape_xyz", "nproc_grid_xyz"]
-    kwargs = {f: generic_transform(getattr(case,f)) for f in generic_fields}
+    kwargs = {
+        "grid_width_xyz": generic_transform(case.grid_width_xyz),
+        "grid_shape_xyz": generic_transform(case.grid_shape_xyz),
+        "nproc_grid_xyz": generic_transform(case.nproc_grid_xyz),
+    }
 
     if origin_loc == OriginLoc.LEFT:
         assert all(v==0 for v in case.grid_left_xyz)
@@ -102,7 +105,7 @@ def _next_case(case: ProblemCase, origin_loc: OriginLoc, scale_rule: ScaleRule):
     elif origin_loc == OriginLoc.CENTER:
         kwargs["grid_left_xyz"] = generic_transform(case.grid_left_xyz)
     else:
-        raise RuntimeError(f"missing branch for {origin_rule}")
+        raise RuntimeError(f"missing branch for {origin_loc}")
 
     return ProblemCase(**kwargs)
 
@@ -111,16 +114,15 @@ def build_cases(base_case: ProblemCase,
                 scale_rule: ScaleRule,
                 max_proc: int,
                 min_generated_proc: int = 1,
-                include_base_case: bool = True):
+                include_base_case: bool = True) -> List[ProblemCase]:
     """
-    Iterate over all allowed cases
+    Build a list of all allowed cases
     """
     assert 1 <= max_proc
     assert 0 <= min_generated_proc <= max_proc
     assert base_case.total_proc() <= max_proc
 
-    if include_base_case:
-        yield base_case
+    out = [base_case] if include_base_case else []
     case = base_case
 
     while True:
@@ -131,8 +133,8 @@ def build_cases(base_case: ProblemCase,
         if total_proc < min_generated_proc:
             continue
         elif total_proc > max_proc:
-            return None
-        yield case
+            return out
+        out.append(case)
 
 # -------------------------------------------------
 # Start defining properties for individual problems
@@ -162,8 +164,79 @@ ProblemRegistry = _build_problem_props(
 # ------------------------------
 # 
 
-def _compile_cholla(cholla_dir: str, hostname: str, maketype: str,
-                    make_jobs: Union[bool, int]=False):
+# records the last successful build performed in a cholla directory
+_LAST_BUILD_FNAME = '.cholla_scaling_last_build'
+
+def _default_make_jobs():
+    # reserve a couple of cores for the rest of the system
+    return max(1, (os.cpu_count() or 1) - 2)
+
+def _build_record(cholla_dir: str, hostname: str, maketype: str):
+    # the make.type file is referenced through a symlink in builds/; os.stat
+    # follows the symlink so that edits to the target invalidate the record
+    maketype_path = os.path.join(
+        cholla_dir, "builds", f"{_MAKETYPE_PREFIX}{maketype}"
+    )
+    return (maketype, hostname, str(os.stat(maketype_path).st_mtime_ns))
+
+def _bin_state(cholla_dir: str, hostname: str, maketype: str):
+    path = os.path.join(cholla_dir, "bin", f"cholla.{maketype}.{hostname}")
+    st = os.stat(path)
+    return (str(st.st_ino), str(st.st_mtime_ns))
+
+def _last_build_matches(cholla_dir: str, hostname: str, maketype: str):
+    """
+    Check whether the last build in cholla_dir used the same inputs and
+    whether cholla_dir has (seemingly) been left alone since then
+    """
+    path = os.path.join(cholla_dir, "builds", _LAST_BUILD_FNAME)
+    try:
+        with open(path, 'r') as f:
+            stored = tuple(f.read().splitlines())
+    except FileNotFoundError:
+        return False
+    if stored[:3] != _build_record(cholla_dir, hostname, maketype):
+        return False
+
+    # the binary we built must be untouched...
+    try:
+        if stored[3:] != _bin_state(cholla_dir, hostname, maketype):
+            return False
+    except FileNotFoundError:
+        return False
+    # ... and no binary can be newer (i.e. nobody built a different TYPE by
+    # hand after we finished)
+    with os.scandir(os.path.join(cholla_dir, "bin")) as it:
+        newest = max(entry.stat().st_mtime_ns for entry in it)
+    return newest <= int(stored[4])
+
+def _forget_last_build(cholla_dir: str):
+    try:
+        os.unlink(os.path.join(cholla_dir, "builds", _LAST_BUILD_FNAME))
+    except FileNotFoundError:
+        pass
+
+def _store_last_build(cholla_dir: str, hostname: str, maketype: str):
+    stored = (_build_record(cholla_dir, hostname, maketype) +
+              _bin_state(cholla_dir, hostname, maketype))
+    path = os.path.join(cholla_dir, "builds", _LAST_BUILD_FNAME)
+    with open(path, 'w') as f:
+        f.write('\n'.join(stored))
+        f.write('\n')
+
+async def _compile_cholla(cholla_dir: str, hostname: str, maketype: str,
+                          make_jobs: Union[bool, int, None]=None):
+    """
+    Compile cholla. When make_jobs is None, we use (almost) every core.
+
+    ``make clean`` is skipped when the previous build in cholla_dir used the
+    same TYPE, MACHINE and (unmodified) make.type file and the resulting
+    binary hasn't been touched since. This persists between invocations.
+    A RuntimeError is raised if any make command fails.
+    """
+    if make_jobs is None:
+        make_jobs = _default_make_jobs()
+
     main_build_args = ["make"]
     if isinstance(make_jobs, bool) and make_jobs:
         main_build_args.append("-j")
@@ -178,35 +251,167 @@ def _compile_cholla(cholla_dir: str, hostname: str, maketype: str,
         raise TypeError("make_jobs must be a bool or an int")
     main_build_args.append(f"TYPE={maketype}")
     main_build_args.append(f"MACHINE={hostname}")
-    commands = [("make", "clean"), main_build_args]
 
-    print(f"About to compile Cholla with TYPE={maketype}")
+    if _last_build_matches(cholla_dir, hostname, maketype):
+        commands = [main_build_args]
+        print(f"About to incrementally compile Cholla with TYPE={maketype}")
+    else:
+        commands = [("make", "clean"), main_build_args]
+        print(f"About to compile Cholla with TYPE={maketype}")
+
+    # forget the last build until we know that this one succeeded
+    _forget_last_build(cholla_dir)
     for command in commands:
-        pretty_subprocess_run(command, cwd=cholla_dir)
+        returncode = await pretty_subprocess_run_async(command, cwd=cholla_dir)
+        if returncode != 0:
+            raise RuntimeError(
+                f"`{' '.join(command)}` failed with returncode {returncode}"
+            )
+    _store_last_build(cholla_dir, hostname, maketype)
+
+def _git_source_state(cholla_dir: str):
+    # returns the current commit & the uncommitted changes to tracked files.
+    # If cholla_dir isn't a git checkout (or git is missing), returns b''
+    state = b''
+    for command in (["git", "rev-parse", "HEAD"],
+                    ["git", "diff", "HEAD", "--no-ext-diff"]):
+        try:
+            proc = subprocess.run(command, cwd=cholla_dir,
+                                  capture_output=True)
+        except FileNotFoundError:
+            return b''
+        if proc.returncode != 0:
+            return b''
+        state += proc.stdout
+    return state
+
+def _build_cache_entry(build_cache_dir: str, cholla_dir: str,
+                       hostname: str, maketype_path: str):
+    # binaries are addressed by the contents of the make.type file, the
+    # cholla directory they were built from and the git state of that
+    # directory. Edits to Cholla's source code are only tracked when it's a
+    # git checkout (and untracked files are never considered)
+    h = hashlib.blake2b(digest_size=16)
+    with open(maketype_path, 'rb') as f:
+        h.update(f.read())
+    h.update(os.path.abspath(cholla_dir).encode())
+    h.update(_git_source_state(cholla_dir))
+    return os.path.join(build_cache_dir, f"{h.hexdigest()}-{hostname}")
+
+async def _setup_cholla_for_problem(cholla_dir: str,
+                                    problem_props: ProblemProps,
+                                    hostname: str,
+                                    make_jobs: Union[bool, int, None],
+                                    build_cache_dir: Optional[str] = None):
+    """
+    Returns the name of the compiled cholla binary and the path to it.
 
-def _setup_cholla_for_problem(cholla_dir: str, problem_props: ProblemProps,
-                              hostname: str, make_jobs: Union[bool, int]):
+    When build_cache_dir is provided, we reuse a previously cached binary
+    (compiled from an identical make.type file and git state) rather than
+    compiling. In that case, the returned path always points into the cache.
+    """
     src, _ = problem_props.maketype_and_param_paths()
+    maketype = os.path.basename(src)[len(_MAKETYPE_PREFIX):]
+    compiled_cholla_name = f'cholla.{maketype}.{hostname}'
+
+    if build_cache_dir is not None:
+        cache_entry = _build_cache_entry(
+            build_cache_dir, cholla_dir, hostname, src
+        )
+        cached_path = os.path.join(cache_entry, compiled_cholla_name)
+        marker_path = os.path.join(cache_entry, "marker")
+        # an entry missing either file (e.g. the binary was deleted) is a miss
+        if os.path.isfile(marker_path) and os.path.isfile(cached_path):
+            print(f"Reusing cached Cholla build with TYPE={maketype}: "
+                  f"{cached_path}")
+            return compiled_cholla_name, cached_path
+
     dst = os.path.join(cholla_dir, "builds", os.path.basename(src))
     if os.path.exists(dst):
         assert os.path.islink(dst)
         os.unlink(dst)
     os.symlink(src=src, dst=dst, target_is_directory=False)
-    maketype = os.path.basename(src)[len(_MAKETYPE_PREFIX):]
 
-    _compile_cholla(
+    # raises if the build fails, so we never cache a stale binary
+    await _compile_cholla(
         cholla_dir=cholla_dir, hostname=hostname, maketype=maketype,
         make_jobs=make_jobs
     )
-
-    compiled_cholla_name = f'cholla.{maketype}.{hostname}'
-    return compiled_cholla_name
+    compiled_path = os.path.join(cholla_dir, "bin", compiled_cholla_name)
+
+    if build_cache_dir is not None:
+        # the marker is written last so that an interrupted store is a miss
+        os.makedirs(cache_entry, exist_ok=True)
+        for path in (marker_path, cached_path):
+            if os.path.exists(path):
+                os.unlink(path)
+        # the cache entry must be an independent copy (bin/ may be rewritten
+        # by later builds). Problem directories are then linked to the entry
+        _copy_file(src=compiled_path, dst=cached_path)
+        with open(marker_path, 'w') as f:
+            f.write(f"{compiled_cholla_name}\n")
+        return compiled_cholla_name, cached_path
+    return compiled_cholla_name, compiled_path
+
+def _copy_file(src: str, dst: str):
+    # shutil.copyfile uses the kernel's fast-path for copying (e.g. sendfile)
+    # where available
+    shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+def _link_or_copy(src: str, dst: str):
+    # a hardlink avoids copying the (potentially large) binary entirely, but
+    # dst then ALIASES src: modifying either one in place modifies both. Only
+    # use this when src is never rewritten in place (i.e. NOT for binaries in
+    # cholla_dir/bin, which the next build may rewrite)
+    try:
+        os.link(src, dst)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                             errno.ENOTSUP):
+            raise
+        _copy_file(src, dst)
 
 def setup_problem_dir(new_dir: str, cholla_dir: str,
                       problem_props: ProblemProps,
                       problem_cases: list,
                       hostname: str,
-                      make_jobs: Union[bool,int] = False):
+                      make_jobs: Union[bool,int,None] = None,
+                      build_cache_dir: Optional[str] = None):
+    asyncio.run(setup_problem_dir_async(
+        new_dir, cholla_dir=cholla_dir, problem_props=problem_props,
+        problem_cases=problem_cases, hostname=hostname, make_jobs=make_jobs,
+        build_cache_dir=build_cache_dir
+    ))
+
+async def setup_problem_dir_async(new_dir: str, cholla_dir: str,
+                                  problem_props: ProblemProps,
+                                  problem_cases: list,
+                                  hostname: str,
+                                  make_jobs: Union[bool,int,None] = None,
+                                  build_lock: Optional[asyncio.Lock] = None,
+                                  build_cache_dir: Optional[str] = None,
+                                  abort: Optional[asyncio.Event] = None):
+    """
+    Coroutine that sets up new_dir for the problem.
+
+    Building Cholla mutates shared state inside of cholla_dir (e.g.
+    ``make clean``). When multiple coroutines are scheduled concurrently,
+    they should all share the same build_lock so that only one build occurs
+    at a time (the remaining setup work is free to overlap).
+
+    When build_cache_dir is provided, compiled binaries are stored in (and
+    reused from) that directory.
+
+    If abort is provided and gets set (e.g. because the setup of another
+    problem failed) before we start building, we give up & return False.
+    Otherwise, we return True once new_dir is set up.
+    """
+    if build_lock is None:
+        build_lock = asyncio.Lock()
+    if abort is not None and abort.is_set():
+        return False
+
     os.symlink(
         src=cholla_dir,
         dst=os.path.join(new_dir, "cholla"),
@@ -216,12 +421,20 @@ def setup_problem_dir(new_dir: str, cholla_dir: str,
     parfile = os.path.basename(parfile_path)
     os.symlink(src=parfile_path, dst=os.path.join(new_dir, parfile))
 
-    chollabin = _setup_cholla_for_problem(
-        cholla_dir, problem_props, hostname, make_jobs=make_jobs
-    )
-    # todo: copy cholla
-    shutil.copy2(src=os.path.join(cholla_dir, "bin", chollabin),
-                 dst=os.path.join(new_dir, chollabin))
+    async with build_lock:
+        if abort is not None and abort.is_set():
+            return False
+        chollabin, chollabin_path = await _setup_cholla_for_problem(
+            cholla_dir, problem_props, hostname, make_jobs=make_jobs,
+            build_cache_dir=build_cache_dir
+        )
+        # copy while holding the lock (the next build may clean bin/)
+        dst = os.path.join(new_dir, chollabin)
+        if os.path.dirname(chollabin_path) == os.path.join(cholla_dir, "bin"):
+            # take an independent snapshot of the binary
+            _copy_file(src=chollabin_path, dst=dst)
+        else:
+            _link_or_copy(src=chollabin_path, dst=dst)
 
     # allow us to swap out launcher
     full_launcher_template = "mpirun -np {nproc}"
@@ -232,31 +445,39 @@ def setup_problem_dir(new_dir: str, cholla_dir: str,
         'grid_shape_xyz' : 'n{ax}',
         'nproc_grid_xyz' : 'n_proc_{ax}',
     }
+    # format every parameter name up front (rather than once per case)
+    field_parnames = [
+        (field, tuple(template.format(ax=ax) for ax in 'xyz'))
+        for field, template in field_partemplate_map.items()
+    ]
+
+    abs_path = os.path.abspath(new_dir)
+    lines = [
+        "# move to directory filled with tests!",
+        f"cd {abs_path}",
+        "",
+        "# run each test",
+    ]
+    for problem_case in problem_cases:
+        nproc = problem_case.total_proc()
+        shell_cmd = [
+            full_launcher_template.format(nproc=nproc),
+            chollabin,
+            parfile
+        ]
+        shell_cmd.extend(
+            f"{parname}={val}"
+            for field, parnames in field_parnames
+            for parname, val in zip(parnames, getattr(problem_case, field))
+        )
+        shell_cmd.append('&>')
+        shell_cmd.append(f'{problem_props.name}_N{nproc}.log')
+        lines.append(' '.join(shell_cmd))
+    lines.append("")
+    lines.append("# done with tests. return to original directory")
+    lines.append("cd -")
+    lines.append("")
 
     with open(os.path.join(new_dir, "run_tests.sh"), 'w') as f:
-        abs_path = os.path.abspath(new_dir)
-        f.write("# move to directory filled with tests!\n")
-        f.write(f"cd {abs_path}\n")
-        f.write("\n")
-        f.write("# run each test\n")
-        for problem_case in problem_cases:
-            nproc = problem_case.total_proc()
-            shell_cmd = [
-                full_launcher_template.format(nproc=nproc),
-                chollabin,
-                parfile
-            ]
-            for field, parname_template in field_partemplate_map.items():
-                for ax, val in zip('xyz', getattr(problem_case, field)):
-                    shell_cmd.append(
-                        f"{parname_template.format(ax=ax)}={val}"
-                    )
-            shell_cmd.append('&>')
-            shell_cmd.append(f'{problem_props.name}_N{nproc}.log')
-
-            f.write(' '.join(shell_cmd))
-            f.write('\n')
-        f.write("\n")
-        f.write("# done with tests. return to original directory\n")
-        f.write("cd -\n")
-
+        f.write('\n'.join(lines))
+    return True